@@ -17,7 +17,12 @@ from __future__ import (division, unicode_literals, print_function,
 import sys
 import re
 import os
+import locale
 import logging
+import mmap
+from bisect import bisect_right
+from collections import namedtuple
+from functools import lru_cache
 from inspect import cleandoc
 from future.utils import istext, isbytes
 from traceback import format_exc
@@ -25,14 +30,25 @@ from traceback import format_exc
 from .errors import DefinitionError
 from .utils import find_header
 
-# Import parsing elements
-from .thirdparty.pyparsing import \
-    (ParserElement, ParseResults, Forward, Optional, Word, WordStart,
-     WordEnd, Keyword, Regex, Literal, SkipTo, ZeroOrMore, OneOrMore,
-     Group, LineEnd, quotedString, oneOf, nestedExpr,
-     delimitedList, restOfLine, cStyleComment, alphas, alphanums, hexnums,
-     lineno, Suppress)
-ParserElement.enablePackrat()
+# Import parsing elements, preferring the Cython-compiled drop-in
+# replacement for pyparsing when it is installed.
+try:
+    from cpyparsing import \
+        (ParserElement, ParseResults, Forward, Optional, Word, WordStart,
+         WordEnd, Keyword, Regex, Literal, SkipTo, ZeroOrMore, OneOrMore,
+         Group, LineEnd, quotedString, oneOf, nestedExpr,
+         delimitedList, restOfLine, cStyleComment, alphas, alphanums, hexnums,
+         lineno, Suppress, Token, ParseException)
+except ImportError:
+    from .thirdparty.pyparsing import \
+        (ParserElement, ParseResults, Forward, Optional, Word, WordStart,
+         WordEnd, Keyword, Regex, Literal, SkipTo, ZeroOrMore, OneOrMore,
+         Group, LineEnd, quotedString, oneOf, nestedExpr,
+         delimitedList, restOfLine, cStyleComment, alphas, alphanums, hexnums,
+         lineno, Suppress, Token, ParseException)
+# Memoize parse attempts; the C grammar backtracks heavily and headers are
+# large, so an unbounded cache pays for itself many times over.
+ParserElement.enablePackrat(cache_size_limit=None)
 
 logger = logging.getLogger(__name__)
 
@@ -40,6 +56,69 @@ logger = logging.getLogger(__name__)
 __all__ = ['win_defs', 'CParser']
 
 
+# Matches quoted strings (kept) and C/C++ comments (stripped). Using a single
+# compiled regex keeps comment stripping inside the C regex engine instead of
+# walking the text through pyparsing.
+_COMMENT_RE = re.compile(r'"(?:\\.|[^"\\\n])*"'
+                         r"|'(?:\\.|[^'\\\n])*'"
+                         r'|/\*[\s\S]*?\*/'
+                         r'|//[^\n]*')
+
+# Matches identifiers outside of quoted strings (strings are matched first so
+# that macro names inside them are left alone). The identifier is in group 4.
+# As in _COMMENT_RE, the quote match may not cross a line, so a stray quote
+# cannot shield the following lines from expansion.
+_IDENT_RE = re.compile(r'("(\\"|[^"\n])*")|(\b(\w+)\b)')
+
+# Matches the 'signed' modifier stripped when evaluating fundamental types.
+_SIGNED_RE = re.compile(r'\bsigned\b')
+
+# Matches the 'defined NAME' / 'defined(NAME)' preprocessor operator.
+_DEFINED_RE = re.compile(r'\bdefined\s*(?:\(\s*([A-Za-z_]\w*)\s*\)'
+                         r'|([A-Za-z_]\w*))')
+
+# Collapses runs of blank lines left by suppressed declarations.
+_BLANK_LINES_RE = re.compile(r'\n\s*\n')
+
+# Matches a preprocessor directive line: name in group 1, rest in group 2.
+# Multiline so a whole file can be scanned for directives in one pass;
+# [^\S\n] is any whitespace but a newline, keeping matches on one line.
+_DIRECTIVE_RE = re.compile(r'^[^\S\n]*#[^\S\n]*([a-zA-Z]+)(.*)$', re.M)
+
+# Splits the name off a #define/#undef body.
+_DEFINE_NAME_RE = re.compile(r'\s*([a-zA-Z_][a-zA-Z0-9_]*)(.*)$')
+
+# Matches the argument list of a #pragma pack directive.
+_PACK_RE = re.compile(r'\s+pack\s*\(([^\)]*)\)')
+
+
+class _FnMacro(object):
+    """Compiled function macro, callable with the list of call arguments.
+
+    Stores (literal, argument-index) pairs; the trailing literal is paired
+    with None. Joining those directly is cheaper than re-parsing a format
+    string on every expansion, and instances stay picklable for the cache.
+
+    """
+    __slots__ = ('pairs',)
+
+    def __init__(self, pairs):
+        self.pairs = pairs
+
+    def __call__(self, args):
+        return ''.join(p + (args[i] if i is not None else '')
+                       for p, i in self.pairs)
+
+    def __eq__(self, other):
+        return isinstance(other, _FnMacro) and self.pairs == other.pairs
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return '_FnMacro({!r})'.format(self.pairs)
+
+
 class Type(tuple):
     """
     Representation of a C type. CParser uses this class to store the parsed
@@ -134,14 +213,11 @@ class Type(tuple):
 
         """
 
-        if (self[0].startswith('struct ') or self[0].startswith('union ') or
-                self[0].startswith('enum ')):
+        if self[0].startswith(('struct ', 'union ', 'enum ')):
             return True
 
-        names = (num_types + nonnum_types + size_modifiers + sign_modifiers +
-                 extra_type_list)
         for w in self[0].split():
-            if w not in names:
+            if w not in _fund_type_names:
                 return False
         return True
 
@@ -164,8 +240,10 @@ class Type(tuple):
 
         if self.is_fund_type():
             # Remove 'signed' before returning evaluated type
-            return Type(re.sub(r'\bsigned\b', '', self.type_spec).strip(),
-                        *self.declarators,
+            spec = self.type_spec
+            if 'signed' in spec:
+                spec = _SIGNED_RE.sub('', spec).strip()
+            return Type(spec, *self.declarators,
                         type_quals=self.type_quals)
 
         parent = self.type_spec
@@ -347,6 +425,11 @@ class CParser(object):
     complete build system. Many files will require some amount of manual
     intervention to parse properly (see 'replace' and extra arguments)
 
+    The parsing grammar is built once per process and shared between
+    instances; its parse actions are routed to whichever instance is
+    currently processing files. Any number of parsers can be used in turn,
+    but files must never be processed by several parsers concurrently.
+
     Parameters
     ----------
     files : str or iterable, optional
@@ -406,7 +489,8 @@ class CParser(object):
     #: Increment every time cache structure or parsing changes to invalidate
     #: old cache files.
     # 2 : add C99 integers
-    cache_version = 2
+    # 3 : store function macros as _FnMacro callables
+    cache_version = 3
 
     #: Private flag allowing to know if the parser has been initiliased.
     _init = False
@@ -449,12 +533,38 @@ class CParser(object):
         # Holds translations from typedefs/structs/unions to fundamental types
         self.compiled_types = {}
 
+        # Caches results of preprocessor expression evaluation
+        self._ppexpr_cache = {}
+
+        # Caches compiled function macro descriptions
+        self._fnmacro_cache = {}
+
+        # Caches code objects for expressions handed to eval, and the
+        # pyparsing expression used to strip casts from them (built lazily
+        # since the grammar is only bound once build_parser has run)
+        self._exprcode_cache = {}
+        self._eval_cast = None
+
+        # Caches processed declarators keyed on their frozen token tree
+        self._decl_cache = {}
+
+        # Maps name -> [(file, category), ...] for find(); built lazily and
+        # kept up to date by add_def/rem_def
+        self._name_index = None
+
+        # Caches line start offsets per file for find_text()
+        self._line_starts = {}
+
         self.current_file = None
 
-        # Import extra arguments if specified
-        for t in kwargs:
-            for k in kwargs[t].keys():
-                self.add_def(t, k, kwargs[t][k])
+        # Import extra arguments if specified. Bulk-insert whole categories
+        # rather than going through add_def per definition.
+        if kwargs:
+            if None not in self.file_defs:
+                self.file_defs[None] = {k: {} for k in self.data_list}
+            for t in kwargs:
+                self.defs[t].update(kwargs[t])
+                self.file_defs[None][t].update(kwargs[t])
 
         # Import from other CParsers if specified
         if copy_from is not None:
@@ -466,6 +576,21 @@ class CParser(object):
         if process_all:
             self.process_all(cache=cache, check_cache_validity=check_cache_validity)
 
+    @property
+    def current_file(self):
+        """Path of the file currently being processed, or None.
+
+        """
+        return self._current_file
+
+    @current_file.setter
+    def current_file(self, path):
+        self._current_file = path
+        # add_def/rem_def run for every definition; cache the basename here
+        # instead of recomputing it on each of those calls.
+        self._current_basename = (None if path is None
+                                  else os.path.basename(path))
+
     def process_all(self, cache=None, return_unparsed=False,
                     print_after_preprocess=False, check_cache_validity=True):
         """ Remove comments, preprocess, and parse declarations from all files.
@@ -566,15 +691,21 @@ class CParser(object):
             mtime = os.stat(cache_file).st_mtime
             for f in self.file_order:
                 # If file does not exist, then it does not count against the
-                # validity of the cache.
-                if os.path.isfile(f) and os.stat(f).st_mtime > mtime:
+                # validity of the cache. A single stat per file serves both
+                # the existence check and the mtime comparison.
+                try:
+                    newer = os.stat(f).st_mtime > mtime
+                except OSError:
+                    continue
+                if newer:
                     logger.debug("Cache file is out of date.")
                     return False
 
         try:
             # Read cache file
             import pickle
-            cache = pickle.load(open(cache_file, 'rb'))
+            with open(cache_file, 'rb', buffering=1 << 20) as f:
+                cache = pickle.load(f)
 
             # Make sure __init__ options match
             if check_validity:
@@ -612,9 +743,17 @@ class CParser(object):
         """
         for f in data.keys():
             self.current_file = f
+            # Bulk-insert whole categories instead of one add_def call per
+            # definition (which would redo the basename/init work each time).
+            base_name = self._current_basename
+            if base_name not in self.file_defs:
+                self.file_defs[base_name] = {k: {} for k in self.data_list}
+            file_defs = self.file_defs[base_name]
             for k in self.data_list:
-                for n in data[f][k]:
-                    self.add_def(k, n, data[f][k][n])
+                self.defs[k].update(data[f][k])
+                file_defs[k].update(data[f][k])
+        # Imported wholesale, so rebuild the name index on the next find()
+        self._name_index = None
 
     def write_cache(self, cache_file):
         """Store all parsed declarations to cache. Used internally.
@@ -625,8 +764,8 @@ class CParser(object):
         cache['file_defs'] = self.file_defs
         cache['version'] = self.cache_version
         import pickle
-        with open(cache_file, 'wb') as f:
-            pickle.dump(cache, f)
+        with open(cache_file, 'wb', buffering=1 << 20) as f:
+            pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
 
     def find_headers(self, headers):
         """Try to find the specified headers.
@@ -667,13 +806,44 @@ class CParser(object):
             self.files[path] = None
             return False
 
-        # U causes all newline types to be converted to \n
-        with open(path, 'rU') as fd:
-            self.files[path] = fd.read()
-
-        if replace is not None:
+        # Map the file and decode straight from the mapping, avoiding an
+        # intermediate bytes copy of large headers. All newline types are
+        # converted to \n as the old universal-newline mode did.
+        with open(path, 'rb') as fd:
+            try:
+                with mmap.mmap(fd.fileno(), 0,
+                               access=mmap.ACCESS_READ) as buf:
+                    text = str(buf, locale.getpreferredencoding(False))
+            except ValueError:
+                # Empty files cannot be mapped.
+                text = fd.read().decode(locale.getpreferredencoding(False))
+        self.files[path] = text.replace('\r\n', '\n').replace('\r', '\n')
+
+        if replace:
+            # Combine all patterns into one alternation so the file is
+            # rewritten in a single pass instead of once per pattern. Each
+            # pattern is wrapped in a group; group_index maps the wrapping
+            # group number back to the pattern (accounting for any groups
+            # the patterns themselves contain).
+            group_index = {}
+            parts = []
+            n = 1
             for s in replace:
-                self.files[path] = re.sub(s, replace[s], self.files[path])
+                cs = re.compile(s)
+                group_index[n] = (cs, replace[s])
+                parts.append('({})'.format(s))
+                n += cs.groups + 1
+            pat = re.compile('|'.join(parts))
+
+            def do_replace(m):
+                for i, (cs, repl) in group_index.items():
+                    if m.group(i) is not None:
+                        # Re-apply the original pattern to its own match so
+                        # group references in the template resolve against
+                        # that pattern's numbering, not the alternation's.
+                        return cs.sub(repl, m.group(i), count=1)
+
+            self.files[path] = pat.sub(do_replace, self.files[path])
 
         self.file_order.append(path)
         bn = os.path.basename(path)
@@ -719,11 +889,10 @@ class CParser(object):
 
         """
         text = self.files[path]
-        cplusplus_line_comment = Literal("//") + restOfLine
-        # match quoted strings first to prevent matching comments inside quotes
-        comment_remover = (quotedString | cStyleComment.suppress() |
-                           cplusplus_line_comment.suppress())
-        self.files[path] = comment_remover.transformString(text)
+        # Quoted strings are matched first (and kept verbatim) to prevent
+        # matching comments inside quotes.
+        self.files[path] = _COMMENT_RE.sub(
+            lambda m: m.group(0) if m.group(0)[0] in '"\'' else '', text)
 
     # --- Pre processing
 
@@ -744,15 +913,17 @@ class CParser(object):
         self.build_parser()
         self.current_file = path
 
-        # Stack for #pragma pack push/pop
+        # Stack for #pragma pack push/pop and the stack index of the
+        # bottom-most entry pushed under each id
         pack_stack = [(None, None)]
+        pack_id_index = {}
         self.pack_list[path] = [(0, None)]
         packing = None  # Current packing value
 
         text = self.files[path]
 
         # First join together lines split by \\n
-        text = Literal('\\\n').suppress().transformString(text)
+        text = text.replace('\\\n', '')
 
         # Define the structure of a macro definition
         name = Word(alphas+'_', alphanums+'_')('name')
@@ -762,174 +933,208 @@ class CParser(object):
                           SkipTo(LineEnd())('value'))
         self.pp_define.setParseAction(self.process_macro_defn)
 
-        # Comb through lines, process all directives
-        lines = text.split('\n')
+        # Files without a single '#' cannot contain directives; expand them
+        # in one go without running the directive scan at all.
+        if '#' not in text:
+            self.files[path] = self.expand_macros(text)
+            return
 
+        # Comb through the file and process all directives. Directive lines
+        # are located with a single multiline regex scan; the stretches of
+        # regular code in between are macro-expanded as whole chunks instead
+        # of line by line.
         result = []
 
-        directive = re.compile(r'\s*#\s*([a-zA-Z]+)(.*)$')
         if_true = [True]
         if_hit = []
-        for i, line in enumerate(lines):
-            new_line = ''
-            m = directive.match(line)
-
-            # Regular code line
-            if m is None:
-                # Only include if we are inside the correct section of an IF
-                # block
+        pos = 0
+        line_no = 0
+        for m in _DIRECTIVE_RE.finditer(text):
+            # Handle the regular code lines since the previous directive.
+            # They are only included if we are inside the correct section
+            # of an IF block; otherwise just their line structure is kept.
+            chunk = text[pos:m.start()]
+            if chunk:
                 if if_true[-1]:
-                    new_line = self.expand_macros(line)
+                    result.append(self.expand_macros(chunk))
+                else:
+                    result.append('\n' * chunk.count('\n'))
+                line_no += chunk.count('\n')
+
+            # The directive line itself (newline included) is consumed and,
+            # unless a branch below drops it, replaced by an empty line.
+            pos = m.end()
+            had_nl = text[pos:pos + 1] == '\n'
+            if had_nl:
+                pos += 1
+            i = line_no
+            line_no += 1
+
+            line = m.group(0)
+            d = m.group(1)
+            rest = m.group(2)
+
+            if d == 'ifdef':
+                d = 'if'
+                rest = 'defined ' + rest
+            elif d == 'ifndef':
+                d = 'if'
+                rest = '!defined ' + rest
+
+            # Evaluate 'defined' operator before expanding macros
+            if d in ['if', 'elif']:
+                def sub(m):
+                    n = m.group(1) or m.group(2)
+                    is_macro = n in self.defs['macros']
+                    is_macro_func = n in self.defs['fnmacros']
+                    return ['0', '1'][is_macro or is_macro_func]
+
+                rest = _DEFINED_RE.sub(sub, rest)
+
+            elif d in ['define', 'undef']:
+                match = _DEFINE_NAME_RE.match(rest)
+                macroName, rest = match.groups()
+
+            # Expand macros if needed
+            if rest is not None and (all(if_true) or d in ['if', 'elif']):
+                rest = self.expand_macros(rest)
+
+            if d == 'elif':
+                if if_hit[-1] or not all(if_true[:-1]):
+                    ev = False
+                else:
+                    ev = self.eval_preprocessor_expr(rest)
 
-            # Macro line
-            else:
-                d = m.groups()[0]
-                rest = m.groups()[1]
-
-                if d == 'ifdef':
-                    d = 'if'
-                    rest = 'defined ' + rest
-                elif d == 'ifndef':
-                    d = 'if'
-                    rest = '!defined ' + rest
-
-                # Evaluate 'defined' operator before expanding macros
-                if d in ['if', 'elif']:
-                    def pa(t):
-                        is_macro = t['name'] in self.defs['macros']
-                        is_macro_func = t['name'] in self.defs['fnmacros']
-                        return ['0', '1'][is_macro or is_macro_func]
-
-                    rest = (Keyword('defined') +
-                            (name | lparen + name + rparen)
-                            ).setParseAction(pa).transformString(rest)
-
-                elif d in ['define', 'undef']:
-                    match = re.match(r'\s*([a-zA-Z_][a-zA-Z0-9_]*)(.*)$', rest)
-                    macroName, rest = match.groups()
-
-                # Expand macros if needed
-                if rest is not None and (all(if_true) or d in ['if', 'elif']):
-                    rest = self.expand_macros(rest)
-
-                if d == 'elif':
-                    if if_hit[-1] or not all(if_true[:-1]):
-                        ev = False
-                    else:
-                        ev = self.eval_preprocessor_expr(rest)
+                logger.debug("  "*(len(if_true)-2) + line +
+                             '{}, {}'.format(rest, ev))
 
-                    logger.debug("  "*(len(if_true)-2) + line +
-                                 '{}, {}'.format(rest, ev))
+                if_true[-1] = ev
+                if_hit[-1] = if_hit[-1] or ev
 
-                    if_true[-1] = ev
-                    if_hit[-1] = if_hit[-1] or ev
+            elif d == 'else':
+                logger.debug("  "*(len(if_true)-2) + line +
+                             '{}'.format(not if_hit[-1]))
+                if_true[-1] = (not if_hit[-1]) and all(if_true[:-1])
+                if_hit[-1] = True
 
-                elif d == 'else':
-                    logger.debug("  "*(len(if_true)-2) + line +
-                                 '{}'.format(not if_hit[-1]))
-                    if_true[-1] = (not if_hit[-1]) and all(if_true[:-1])
-                    if_hit[-1] = True
+            elif d == 'endif':
+                if_true.pop()
+                if_hit.pop()
+                logger.debug("  "*(len(if_true)-1) + line)
 
-                elif d == 'endif':
-                    if_true.pop()
-                    if_hit.pop()
-                    logger.debug("  "*(len(if_true)-1) + line)
+            elif d == 'if':
+                if all(if_true):
+                    ev = self.eval_preprocessor_expr(rest)
+                else:
+                    ev = False
+                logger.debug("  "*(len(if_true)-1) + line +
+                             '{}, {}'.format(rest, ev))
+                if_true.append(ev)
+                if_hit.append(ev)
+
+            elif d == 'define':
+                if not if_true[-1]:
+                    continue
+                logger.debug("  "*(len(if_true)-1) + "define: " +
+                             '{}, {}'.format(macroName, rest))
+                try:
+                    # Macro is registered here
+                    self.pp_define.parseString(macroName + ' ' + rest)
+                except Exception:
+                    logger.exception("Error processing macro definition:" +
+                                     '{}, {}'.format(macroName, rest))
 
-                elif d == 'if':
-                    if all(if_true):
-                        ev = self.eval_preprocessor_expr(rest)
+            elif d == 'undef':
+                if not if_true[-1]:
+                    continue
+                try:
+                    self.rem_def('macros', macroName.strip())
+                except Exception:
+                    if sys.exc_info()[0] is not KeyError:
+                        mess = "Error removing macro definition '{}'"
+                        logger.exception(mess.format(macroName.strip()))
+
+            # Check for changes in structure packing
+            # Support only for #pragme pack (with all its variants
+            # save show), None is used to signal that the default packing
+            # is used.
+            # Those two definition disagree :
+            # https://gcc.gnu.org/onlinedocs/gcc/Structure-Packing-Pragmas.html
+            # http://msdn.microsoft.com/fr-fr/library/2e70t5y1.aspx
+            # The current implementation follows the MSVC doc.
+            elif d == 'pragma':
+                if not if_true[-1]:
+                    continue
+                m = _PACK_RE.match(rest)
+                if not m:
+                    continue
+                if m.groups():
+                    opts = [s.strip() for s in m.groups()[0].split(',')]
+
+                pushpop = id = val = None
+                for o in opts:
+                    if o in ['push', 'pop']:
+                        pushpop = o
+                    elif o.isdigit():
+                        val = int(o)
                     else:
-                        ev = False
-                    logger.debug("  "*(len(if_true)-1) + line +
-                                 '{}, {}'.format(rest, ev))
-                    if_true.append(ev)
-                    if_hit.append(ev)
-
-                elif d == 'define':
-                    if not if_true[-1]:
-                        continue
-                    logger.debug("  "*(len(if_true)-1) + "define: " +
-                                 '{}, {}'.format(macroName, rest))
-                    try:
-                        # Macro is registered here
-                        self.pp_define.parseString(macroName + ' ' + rest)
-                    except Exception:
-                        logger.exception("Error processing macro definition:" +
-                                         '{}, {}'.format(macroName, rest))
-
-                elif d == 'undef':
-                    if not if_true[-1]:
-                        continue
-                    try:
-                        self.rem_def('macros', macroName.strip())
-                    except Exception:
-                        if sys.exc_info()[0] is not KeyError:
-                            mess = "Error removing macro definition '{}'"
-                            logger.exception(mess.format(macroName.strip()))
-
-                # Check for changes in structure packing
-                # Support only for #pragme pack (with all its variants
-                # save show), None is used to signal that the default packing
-                # is used.
-                # Those two definition disagree :
-                # https://gcc.gnu.org/onlinedocs/gcc/Structure-Packing-Pragmas.html
-                # http://msdn.microsoft.com/fr-fr/library/2e70t5y1.aspx
-                # The current implementation follows the MSVC doc.
-                elif d == 'pragma':
-                    if not if_true[-1]:
-                        continue
-                    m = re.match(r'\s+pack\s*\(([^\)]*)\)', rest)
-                    if not m:
-                        continue
-                    if m.groups():
-                        opts = [s.strip() for s in m.groups()[0].split(',')]
-
-                    pushpop = id = val = None
-                    for o in opts:
-                        if o in ['push', 'pop']:
-                            pushpop = o
-                        elif o.isdigit():
-                            val = int(o)
-                        else:
-                            id = o
-
-                    packing = val
-
-                    if pushpop == 'push':
-                        pack_stack.append((packing, id))
-                    elif opts[0] == 'pop':
-                        if id is None:
-                            pack_stack.pop()
-                        else:
-                            ind = None
-                            for j, s in enumerate(pack_stack):
-                                if s[1] == id:
-                                    ind = j
-                                    break
-                            if ind is not None:
-                                pack_stack = pack_stack[:ind]
-                        if val is None:
-                            packing = pack_stack[-1][0]
-
-                    mess = ">> Packing changed to {} at line {}"
-                    logger.debug(mess.format(str(packing), i))
-                    self.pack_list[path].append((i, packing))
-                else:
-                    # Ignore any other directives
-                    mess = 'Ignored directive {} at line {}'
-                    logger.debug(mess.format(d, i))
+                        id = o
+
+                packing = val
+
+                if pushpop == 'push':
+                    pack_stack.append((packing, id))
+                    if id is not None:
+                        # Record the bottom-most occurrence of each id so
+                        # pop-by-id needs no linear search of the stack.
+                        pack_id_index.setdefault(id, len(pack_stack) - 1)
+                elif opts[0] == 'pop':
+                    if id is None:
+                        popped = pack_stack.pop()
+                        if pack_id_index.get(popped[1]) == len(pack_stack):
+                            del pack_id_index[popped[1]]
+                    else:
+                        ind = pack_id_index.get(id)
+                        if ind is not None:
+                            pack_stack = pack_stack[:ind]
+                            pack_id_index = {k: v
+                                             for k, v in
+                                             pack_id_index.items()
+                                             if v < ind}
+                    if val is None:
+                        packing = pack_stack[-1][0]
+
+                mess = ">> Packing changed to {} at line {}"
+                logger.debug(mess.format(str(packing), i))
+                self.pack_list[path].append((i, packing))
+            else:
+                # Ignore any other directives
+                mess = 'Ignored directive {} at line {}'
+                logger.debug(mess.format(d, i))
+
+            result.append('\n' if had_nl else '')
+
+        # Regular code after the last directive.
+        chunk = text[pos:]
+        if chunk:
+            if if_true[-1]:
+                result.append(self.expand_macros(chunk))
+            else:
+                result.append('\n' * chunk.count('\n'))
 
-            result.append(new_line)
-        self.files[path] = '\n'.join(result)
+        self.files[path] = ''.join(result)
 
     def eval_preprocessor_expr(self, expr):
+        # Macros and 'defined' operators were expanded beforehand, so the
+        # result only depends on the expression string itself and can be
+        # cached. Headers re-evaluate the same few guards over and over.
+        try:
+            return self._ppexpr_cache[expr]
+        except KeyError:
+            pass
+
         # Make a few alterations so the expression can be eval'd
-        macro_diffs = (
-            Literal('!').setParseAction(lambda: ' not ') |
-            Literal('&&').setParseAction(lambda: ' and ') |
-            Literal('||').setParseAction(lambda: ' or ') |
-            Word(alphas + '_', alphanums + '_').setParseAction(lambda: '0'))
-        expr2 = macro_diffs.transformString(expr).strip()
+        expr2 = _pp_macro_diffs.transformString(expr).strip()
 
         try:
             ev = bool(eval(expr2))
@@ -937,6 +1142,7 @@ class CParser(object):
             mess = "Error evaluating preprocessor expression: {} [{}]\n{}"
             logger.debug(mess.format(expr, repr(expr2), format_exc()))
             ev = False
+        self._ppexpr_cache[expr] = ev
         return ev
 
     def process_macro_defn(self, t):
@@ -945,33 +1151,48 @@ class CParser(object):
         """
         logger.debug("Processing MACRO: {}".format(t))
         macro_val = t.value.strip()
+        # Interning the name deduplicates the thousands of identifier
+        # strings built by the tokenizer and speeds up the 'name in macros'
+        # lookups that expand_macros performs on every identifier.
+        macro_name = sys.intern(str(t.macro))
         if macro_val in self.defs['fnmacros']:
-            self.add_def('fnmacros', t.macro, self.defs['fnmacros'][macro_val])
-            logger.debug("  Copy fn macro {} => {}".format(macro_val, t.macro))
+            self.add_def('fnmacros', macro_name,
+                         self.defs['fnmacros'][macro_val])
+            logger.debug("  Copy fn macro {} => {}".format(macro_val,
+                                                           macro_name))
 
         else:
             if t.args == '':
                 val = self.eval_expr(macro_val)
-                self.add_def('macros', t.macro, macro_val)
-                self.add_def('values', t.macro, val)
+                self.add_def('macros', macro_name, macro_val)
+                self.add_def('values', macro_name, val)
                 mess = "  Add macro: {} ({}); {}"
-                logger.debug(mess.format(t.macro, val,
-                                         self.defs['macros'][t.macro]))
+                logger.debug(mess.format(macro_name, val,
+                                         self.defs['macros'][macro_name]))
 
             else:
-                self.add_def('fnmacros', t.macro,
+                self.add_def('fnmacros', macro_name,
                              self.compile_fn_macro(macro_val,
                                                    [x for x in t.args]))
                 mess = "  Add fn macro: {} ({}); {}"
-                logger.debug(mess.format(t.macro, t.args,
-                                         self.defs['fnmacros'][t.macro]))
+                logger.debug(mess.format(macro_name, t.args,
+                                         self.defs['fnmacros'][macro_name]))
 
-        return "#define " + t.macro + " " + macro_val
+        return "#define " + macro_name + " " + macro_val
 
     def compile_fn_macro(self, text, args):
         """Turn a function macro spec into a compiled description.
 
+        Identical specs (common in headers redefining the same macro) are
+        compiled only once per parser.
+
         """
+        key = (text, tuple(args))
+        try:
+            return self._fnmacro_cache[key]
+        except KeyError:
+            pass
+
         # Find all instances of each arg in text.
         args_str = '|'.join(args)
         arg_regex = re.compile(r'("(\\"|[^"])*")|(\b({})\b)'.format(args_str))
@@ -983,11 +1204,13 @@ class CParser(object):
         for m in arg_regex.finditer(text):
             arg = m.groups()[N]
             if arg is not None:
-                parts.append(text[start:m.start(N)] + '{}')
+                parts.append(text[start:m.start(N)])
                 start = m.end(N)
                 arg_order.append(args.index(arg))
         parts.append(text[start:])
-        return (''.join(parts), arg_order)
+        compiled = _FnMacro(list(zip(parts, arg_order + [None])))
+        self._fnmacro_cache[key] = compiled
+        return compiled
 
     def expand_macros(self, line):
         """Expand all the macro expressions in a string.
@@ -995,64 +1218,65 @@ class CParser(object):
         Faulty calls to macro function are left untouched.
 
         """
-        reg = re.compile(r'("(\\"|[^"])*")|(\b(\w+)\b)')
         parts = []
-        # The group number to check for macro names
-        N = 3
+        # The group holding the macro name
+        N = 4
         macros = self.defs['macros']
         fnmacros = self.defs['fnmacros']
+        search = _IDENT_RE.search
+        pos = 0
         while True:
-            m = reg.search(line)
+            m = search(line, pos)
             if not m:
                 break
-            name = m.groups()[N]
-            if name in macros:
-                parts.append(line[:m.start(N)])
-                line = line[m.end(N):]
+            name = m.group(N)
+            if name is None:
+                # Matched a quoted string, skip it as a whole.
+                parts.append(line[pos:m.end()])
+                pos = m.end()
+
+            elif name in macros:
+                parts.append(line[pos:m.start(N)])
                 parts.append(macros[name])
+                pos = m.end(N)
 
             elif name in fnmacros:
                 # If function macro expansion fails, just ignore it.
                 try:
                     exp, end = self.expand_fn_macro(name, line[m.end(N):])
                 except Exception:
-                    exp = name
-                    end = line[m.end(N):]
                     mess = "Function macro expansion failed: {}, {}\n {}"
                     logger.error(mess.format(name, line[m.end(N):],
                                              format_exc()))
-
-                parts.append(line[:m.start(N)])
-                line = end
-                parts.append(exp)
+                    parts.append(line[pos:m.end(N)])
+                    pos = m.end(N)
+                else:
+                    parts.append(line[pos:m.start(N)])
+                    parts.append(exp)
+                    pos = len(line) - len(end)
 
             else:
-                start = m.end(N)
-                parts.append(line[:start])
-                line = line[start:]
+                parts.append(line[pos:m.end(N)])
+                pos = m.end(N)
 
-        parts.append(line)
+        parts.append(line[pos:])
         return ''.join(parts)
 
     def expand_fn_macro(self, name, text):
         """Replace a function macro.
 
         """
-        # defn looks like ('%s + %s / %s', (0, 0, 1))
+        # defn is a _FnMacro built by compile_fn_macro
         defn = self.defs['fnmacros'][name]
 
         try:
-            args, end = text.split(')', 1)
-            _, args = args.split('(', 1)
-            args = [a.strip() for a in args.split(',')]
+            args, end_ind = _split_fn_macro_args(text)
         except Exception:
             mess = "Function macro {} argument analysis failed :\n{}"
             raise DefinitionError(0,  mess.format(name, format_exc()))
 
         args = [self.expand_macros(arg) for arg in args]
-        new_str = defn[0].format(*[args[i] for i in defn[1]])
-
-        return (new_str, end)
+        return (defn(args), text[end_ind:])
 
     # --- Compilation functions
 
@@ -1079,165 +1303,83 @@ class CParser(object):
 
         parser = self.build_parser()
         if return_unparsed:
-            text = parser.suppress().transformString(self.files[path])
-            return re.sub(r'\n\s*\n', '\n', text)
+            if not hasattr(self, '_suppressed_parser'):
+                self._suppressed_parser = parser.suppress()
+            text = self._suppressed_parser.transformString(self.files[path])
+            return _BLANK_LINES_RE.sub('\n', text)
         else:
-            return [x[0] for x in parser.scanString(self.files[path])]
+            text = self._parse_simple_typedefs(self.files[path])
+            return [x[0] for x in parser.scanString(text)]
+
+    def _parse_simple_typedefs(self, text):
+        """Handle single-line typedefs of plain fundamental types directly.
+
+        Only typedefs at brace depth zero are taken -- ones inside function
+        bodies are stepped over by the grammar pass and must not register
+        anything. The matched declarations are registered through add_def
+        and blanked out with spaces (offsets are preserved, so line numbers
+        reported by the grammar pass are unaffected); everything else is
+        left for the full grammar.
+
+        """
+        out = []
+        copied = 0
+        pos = 0
+        depth = 0
+        for m in _SIMPLE_TYPEDEF_RE.finditer(text):
+            # Update the brace depth over the stretch since the last match
+            # (the match itself cannot contain braces or quotes).
+            for b in _BRACE_RE.finditer(text, pos, m.start()):
+                c = b.group()
+                if c == '{':
+                    depth += 1
+                elif c == '}':
+                    depth -= 1
+            pos = m.end()
+            if depth > 0:
+                continue
+            spec = ' '.join(m.group(1).split())
+            for name in m.group(2).split(','):
+                self.add_def('types', name.strip(),
+                             Type(spec, type_quals=((),)))
+            out.append(text[copied:m.start()])
+            out.append(' ' * (m.end() - m.start()))
+            copied = m.end()
+        if not out:
+            return text
+        out.append(text[copied:])
+        return ''.join(out)
 
     def build_parser(self):
-        """Builds the entire tree of parser elements for the C language (the
-        bits we support, anyway).
+        """Bind the tree of parser elements for the C language (the bits we
+        support, anyway) onto this instance.
+
+        The grammar itself is built once per process by _build_grammar and
+        shared between instances; parse actions dispatch to the parser
+        currently using it.
 
         """
+        global _active_parser
+        _active_parser = self
         if hasattr(self, 'parser'):
             return self.parser
 
-        self.struct_type = Forward()
-        self.enum_type = Forward()
-        type_ = (fund_type |
-                 Optional(kwl(size_modifiers + sign_modifiers)) + ident |
-                 self.struct_type |
-                 self.enum_type)
-        if extra_modifier is not None:
-            type_ += extra_modifier
-        type_.setParseAction(recombine)
-        self.type_spec = (type_qualifier('pre_qual') +
-                          type_("name"))
-
-        # --- Abstract declarators for use in function pointer arguments
-        #   Thus begins the extremely hairy business of parsing C declarators.
-        #   Whomever decided this was a reasonable syntax should probably never
-        #   breed.
-        #   The following parsers combined with the process_declarator function
-        #   allow us to turn a nest of type modifiers into a correctly
-        #   ordered list of modifiers.
-
-        self.declarator = Forward()
-        self.abstract_declarator = Forward()
-
-        #  Abstract declarators look like:
-        #     <empty string>
-        #     *
-        #     **[num]
-        #     (*)(int, int)
-        #     *( )(int, int)[10]
-        #     ...etc...
-        self.abstract_declarator << Group(
-            type_qualifier('first_typequal') +
-            Group(ZeroOrMore(Group(Suppress('*') + type_qualifier)))('ptrs') +
-            ((Optional('&')('ref')) |
-             (lparen + self.abstract_declarator + rparen)('center')) +
-            Optional(lparen +
-                     Optional(delimitedList(Group(
-                              self.type_spec('type') +
-                              self.abstract_declarator('decl') +
-                              Optional(Literal('=').suppress() + expression,
-                                       default=None)('val')
-                              )), default=None) +
-                     rparen)('args') +
-            Group(ZeroOrMore(lbrack + Optional(expression, default='-1') +
-                  rbrack))('arrays')
-        )
-
-        # Declarators look like:
-        #     varName
-        #     *varName
-        #     **varName[num]
-        #     (*fnName)(int, int)
-        #     * fnName(int arg1=0)[10]
-        #     ...etc...
-        self.declarator << Group(
-            type_qualifier('first_typequal') + call_conv +
-            Group(ZeroOrMore(Group(Suppress('*') + type_qualifier)))('ptrs') +
-            ((Optional('&')('ref') + ident('name')) |
-             (lparen + self.declarator + rparen)('center')) +
-            Optional(lparen +
-                     Optional(delimitedList(
-                         Group(self.type_spec('type') +
-                               (self.declarator |
-                                self.abstract_declarator)('decl') +
-                               Optional(Literal('=').suppress() +
-                               expression, default=None)('val')
-                               )),
-                              default=None) +
-                     rparen)('args') +
-            Group(ZeroOrMore(lbrack + Optional(expression, default='-1') +
-                  rbrack))('arrays')
-        )
-        self.declarator_list = Group(delimitedList(self.declarator))
-
-        # Typedef
-        self.type_decl = (Keyword('typedef') + self.type_spec('type') +
-                          self.declarator_list('decl_list') + semi)
-        self.type_decl.setParseAction(self.process_typedef)
-
-        # Variable declaration
-        self.variable_decl = (
-            Group(storage_class_spec +
-                  self.type_spec('type') +
-                  Optional(self.declarator_list('decl_list')) +
-                  Optional(Literal('=').suppress() +
-                           (expression('value') |
-                            (lbrace +
-                             Group(delimitedList(expression))('array_values') +
-                             rbrace
-                             )
-                            )
-                           )
-                  ) +
-            semi)
-        self.variable_decl.setParseAction(self.process_variable)
-
-        # Function definition
-        self.typeless_function_decl = (self.declarator('decl') +
-                                       nestedExpr('{', '}').suppress())
-        self.function_decl = (storage_class_spec +
-                              self.type_spec('type') +
-                              self.declarator('decl') +
-                              nestedExpr('{', '}').suppress())
-        self.function_decl.setParseAction(self.process_function)
-
-        # Struct definition
-        self.struct_decl = Forward()
-        struct_kw = (Keyword('struct') | Keyword('union'))
-        self.struct_member = (
-            Group(self.variable_decl.copy().setParseAction(lambda: None)) |
-            # Hack to handle bit width specification.
-            Group(Group(self.type_spec('type') +
-                        Optional(self.declarator_list('decl_list')) +
-                        colon + integer('bit') + semi)) |
-            (self.type_spec + self.declarator +
-             nestedExpr('{', '}')).suppress() |
-            (self.declarator + nestedExpr('{', '}')).suppress()
-            )
-
-        self.decl_list = (lbrace +
-                          Group(OneOrMore(self.struct_member))('members') +
-                          rbrace)
-        self.struct_type << (struct_kw('struct_type') +
-                             ((Optional(ident)('name') +
-                               self.decl_list) | ident('name'))
-                             )
-        self.struct_type.setParseAction(self.process_struct)
-
-        self.struct_decl = self.struct_type + semi
-
-        # Enum definition
-        enum_var_decl = Group(ident('name') +
-                              Optional(Literal('=').suppress() +
-                              expression('value')))
-
-        self.enum_type << (Keyword('enum') +
-                           (Optional(ident)('name') +
-                            lbrace +
-                            Group(delimitedList(enum_var_decl))('members') +
-                            Optional(comma) + rbrace | ident('name'))
-                           )
-        self.enum_type.setParseAction(self.process_enum)
-        self.enum_decl = self.enum_type + semi
-
-        self.parser = (self.type_decl | self.variable_decl |
-                       self.function_decl)
+        g = _build_grammar()
+        self.type_spec = g.type_spec
+        self.declarator = g.declarator
+        self.abstract_declarator = g.abstract_declarator
+        self.declarator_list = g.declarator_list
+        self.type_decl = g.type_decl
+        self.variable_decl = g.variable_decl
+        self.typeless_function_decl = g.typeless_function_decl
+        self.function_decl = g.function_decl
+        self.struct_type = g.struct_type
+        self.struct_member = g.struct_member
+        self.decl_list = g.decl_list
+        self.struct_decl = g.struct_decl
+        self.enum_type = g.enum_type
+        self.enum_decl = g.enum_decl
+        self.parser = g.parser
         return self.parser
 
     def process_declarator(self, decl):
@@ -1247,49 +1389,80 @@ class CParser(object):
         See process_type(...) for more information.
 
         """
+        # Attribute access on ParseResults returns an empty value for
+        # missing names, so one lookup replaces the membership scan plus
+        # the re-scan of the 'X' in decl / decl['X'] pattern.
+        ptrs = decl.ptrs
+        arrays = decl.arrays
+        args = decl.args
+        call_conv = decl.call_conv
+        center = decl.center
+        first_typequal = decl.first_typequal
+
+        # The vast majority of declarators are a bare identifier; answer
+        # those without freezing the token tree or walking the full ladder
+        # of modifier checks below.
+        if (decl.name and not center and not args and not decl.ref
+                and not ptrs and not arrays and not call_conv
+                and not first_typequal):
+            return (decl.name, [], ((),))
+
+        # Headers repeat the same declarators (plain ints, char pointers...)
+        # thousands of times; memoize those whose processing only depends on
+        # the tokens themselves.
+        key = _freeze_decl(decl)
+        if key is not _UNCACHEABLE:
+            cached = self._decl_cache.get(key)
+            if cached is not None:
+                (name, toks, quals) = cached
+                return (name, list(toks), quals)
+
         toks = []
-        quals = [tuple(decl.get('first_typequal', []))]
+        quals = [tuple(first_typequal)]
         name = None
         logger.debug("DECL: {}".format(decl))
 
-        if 'call_conv' in decl and len(decl['call_conv']) > 0:
-            toks.append(decl['call_conv'])
+        if call_conv:
+            toks.append(call_conv)
             quals.append(None)
 
-        if 'ptrs' in decl and len(decl['ptrs']) > 0:
-            toks += ('*',) * len(decl['ptrs'])
-            quals += map(tuple, decl['ptrs'])
+        if ptrs:
+            toks += ('*',) * len(ptrs)
+            quals += map(tuple, ptrs)
 
-        if 'arrays' in decl and len(decl['arrays']) > 0:
-            toks.extend([self.eval_expr(x)] for x in decl['arrays'])
-            quals += [()] * len(decl['arrays'])
+        if arrays:
+            toks.extend([self.eval_expr(x)] for x in arrays)
+            quals += [()] * len(arrays)
 
-        if 'args' in decl and len(decl['args']) > 0:
-            if decl['args'][0] is None:
+        if args:
+            if args[0] is None:
                 toks.append(())
             else:
                 ex = lambda x: (x[0],) if len(x)!=0 else (None,)
                 toks.append(tuple([self.process_type(a['type'],
                                                      a['decl']) +
-                                   ex(a['val']) for a in decl['args']]
+                                   ex(a['val']) for a in args]
                                   )
                             )
             quals.append(())
-        if 'ref' in decl:
+        if decl.ref:
             toks.append('&')
             quals.append(())
 
-        if 'center' in decl:
-            (n, t, q) = self.process_declarator(decl['center'][0])
+        if center:
+            (n, t, q) = self.process_declarator(center[0])
             if n is not None:
                 name = n
             toks.extend(t)
             quals = quals[:-1] + [quals[-1] + q[0]] + list(q[1:])
 
-        if 'name' in decl:
-            name = decl['name']
+        if decl.name:
+            name = decl.name
 
-        return (name, toks, tuple(quals))
+        quals = tuple(quals)
+        if key is not _UNCACHEABLE:
+            self._decl_cache[key] = (name, list(toks), quals)
+        return (name, toks, quals)
 
     def process_type(self, typ, decl):
         """Take a declarator + base type and return a serialized name/type
@@ -1346,10 +1519,16 @@ class CParser(object):
                 enum = {}
                 for v in t.members:
                     if v.value != '':
+                        # Values are almost always plain integer literals;
+                        # only fall back on the full expression evaluator
+                        # when they are not.
                         try:
-                            i = self.eval_expr(v.value)
-                        except Exception:
-                            pass
+                            i = int(v.value, 0)
+                        except ValueError:
+                            try:
+                                i = self.eval_expr(v.value)
+                            except Exception:
+                                pass
                     enum[v.name] = i
                     self.add_def('values', v.name, i)
                     i += 1
@@ -1493,6 +1672,24 @@ class CParser(object):
 
         """
         logger.debug("Eval: {}".format(toks))
+        if istext(toks):
+            # Enum values and array bounds are almost always numeric
+            # literals (possibly with integer suffixes); answer those
+            # without going through the full eval machinery.
+            s = toks.strip()
+            if not s:
+                return None
+            if s[0] in '+-.0123456789':
+                u = s.rstrip('UL')
+                try:
+                    return int(u, 0)
+                except ValueError:
+                    pass
+                if '.' in u or 'e' in u or 'E' in u:
+                    try:
+                        return float(u)
+                    except ValueError:
+                        pass
         try:
             if istext(toks) or isbytes(toks):
                 val = self.eval(toks, None, self.defs['values'])
@@ -1512,12 +1709,26 @@ class CParser(object):
     def eval(self, expr, *args):
         """Just eval with a little extra robustness."""
         expr = expr.strip()
-        cast = (lparen + self.type_spec + self.abstract_declarator +
-                rparen).suppress()
-        expr = (quotedString | number | cast).transformString(expr)
-        if expr == '':
+        try:
+            # Most expressions are plain integer literals; evaluating them
+            # directly skips both the cast-stripping pass and the compiler.
+            return int(expr, 0)
+        except ValueError:
+            pass
+        try:
+            code = self._exprcode_cache[expr]
+        except KeyError:
+            if self._eval_cast is None:
+                cast = (lparen + self.type_spec + self.abstract_declarator +
+                        rparen).suppress()
+                self._eval_cast = quotedString | number | cast
+            cleaned = self._eval_cast.transformString(expr)
+            code = (compile(cleaned, '<eval>', 'eval') if cleaned != ''
+                    else None)
+            self._exprcode_cache[expr] = code
+        if code is None:
             return None
-        return eval(expr, *args)
+        return eval(code, *args)
 
     def add_def(self, typ, name, val):
         """Add a definition of a specific type to both the definition set for
@@ -1525,27 +1736,27 @@ class CParser(object):
 
         """
         self.defs[typ][name] = val
-        if self.current_file is None:
-            base_name = None
-        else:
-            base_name = os.path.basename(self.current_file)
-        if base_name not in self.file_defs:
-            self.file_defs[base_name] = {}
-            for k in self.data_list:
-                self.file_defs[base_name][k] = {}
-        self.file_defs[base_name][typ][name] = val
+        base_name = self._current_basename
+        try:
+            file_defs = self.file_defs[base_name]
+        except KeyError:
+            file_defs = {k: {} for k in self.data_list}
+            self.file_defs[base_name] = file_defs
+        if (self._name_index is not None and
+                name not in file_defs[typ]):
+            self._name_index.setdefault(name, []).append((base_name, typ))
+        file_defs[typ][name] = val
 
     def rem_def(self, typ, name):
         """Remove a definition of a specific type to both the definition set
         for the current file and the global definition set.
 
         """
-        if self.current_file is None:
-            base_name = None
-        else:
-            base_name = os.path.basename(self.current_file)
+        base_name = self._current_basename
         del self.defs[typ][name]
         del self.file_defs[base_name][typ][name]
+        if self._name_index is not None:
+            self._name_index[name].remove((base_name, typ))
 
     def is_fund_type(self, typ):
         """Return True if this type is a fundamental C type, struct, or
@@ -1568,52 +1779,190 @@ class CParser(object):
             typ = Type(*typ)
         return typ.eval(self.defs['types'])
 
+    def _build_name_index(self):
+        """Build the name -> [(file, category), ...] map used by find().
+
+        """
+        index = {}
+        for f, fd in self.file_defs.items():
+            for t, typ in fd.items():
+                for k in typ:
+                    index.setdefault(k, []).append((f, t))
+        self._name_index = index
+
     def find(self, name):
         """Search all definitions for the given name.
 
         """
+        if self._name_index is None:
+            self._build_name_index()
+        if istext(name):
+            return list(self._name_index.get(name, []))
         res = []
-        for f in self.file_defs:
-            fd = self.file_defs[f]
-            for t in fd:
-                typ = fd[t]
-                for k in typ:
-                    if istext(name):
-                        if k == name:
-                            res.append((f, t))
-                    else:
-                        if re.match(name, k):
-                            res.append((f, t, k))
+        for k, entries in self._name_index.items():
+            if re.match(name, k):
+                res.extend((f, t, k) for (f, t) in entries)
         return res
 
     def find_text(self, text):
         """Search all file strings for text, return matching lines.
 
         """
+        pattern = re.compile(re.escape(text))
         res = []
-        for f in self.files:
-            l = self.files[f].split('\n')
-            for i in range(len(l)):
-                if text in l[i]:
-                    res.append((f, i, l[i]))
+        for f, body in self.files.items():
+            # Scan the whole body at once and map match offsets back to
+            # line numbers through cached line start offsets.
+            cached = self._line_starts.get(f)
+            if cached is None or cached[0] is not body:
+                starts = [0] + [m.end() for m in re.finditer('\n', body)]
+                cached = (body, starts)
+                self._line_starts[f] = cached
+            starts = cached[1]
+            last = -1
+            for m in pattern.finditer(body):
+                i = bisect_right(starts, m.start()) - 1
+                if i == last:
+                    continue
+                last = i
+                end = body.find('\n', starts[i])
+                line = body[starts[i]:] if end == -1 else body[starts[i]:end]
+                res.append((f, i, line))
         return res
 
 
 # --- Basic parsing elements.
 
+def _split_fn_macro_args(text):
+    """Split the argument list of a function macro call.
+
+    text must start at the opening parenthesis (leading whitespace is
+    allowed). Returns the list of top-level arguments and the index just
+    past the closing parenthesis. Nested parentheses and quoted strings
+    are skipped wholesale.
+
+    """
+    n = len(text)
+    i = 0
+    while i < n and text[i].isspace():
+        i += 1
+    if i == n or text[i] != '(':
+        raise ValueError("Expected an argument list.")
+
+    args = []
+    depth = 1
+    i += 1
+    start = i
+    while i < n:
+        c = text[i]
+        if c == '"' or c == "'":
+            i += 1
+            while i < n and text[i] != c:
+                i += 2 if text[i] == '\\' else 1
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+            if depth == 0:
+                args.append(text[start:i].strip())
+                return (args, i + 1)
+        elif c == ',' and depth == 1:
+            args.append(text[start:i].strip())
+            start = i + 1
+        i += 1
+
+    raise ValueError("Unbalanced parenthesis in argument list.")
+
+
+#: Sentinel marking declarators that cannot be safely memoized.
+_UNCACHEABLE = object()
+
+
+def _freeze_decl(decl):
+    """Build a hashable key for a declarator's ParseResults tree.
+
+    Returns _UNCACHEABLE for declarators containing array sizes, whose
+    evaluation depends on the definitions collected so far.
+
+    """
+    if not isinstance(decl, ParseResults):
+        return decl
+    named = []
+    for k in decl.keys():
+        # The grammar attaches an (often empty) arrays group to every
+        # declarator; only actual size expressions make it uncacheable.
+        if k == 'arrays' and len(decl[k]) > 0:
+            return _UNCACHEABLE
+        v = _freeze_decl(decl[k])
+        if v is _UNCACHEABLE:
+            return _UNCACHEABLE
+        named.append((k, v))
+    vals = []
+    for v in decl:
+        f = _freeze_decl(v)
+        if f is _UNCACHEABLE:
+            return _UNCACHEABLE
+        vals.append(f)
+    return (tuple(vals), tuple(sorted(named)))
+
+
 def kwl(strs):
     """Generate a match-first list of keywords given a list of strings."""
     return Regex(r'\b({})\b'.format('|'.join(strs)))
 
 
+class _SkipBracedBlock(Token):
+    """Match a braced block without tokenizing its content.
+
+    Used in place of nestedExpr('{', '}').suppress() to step over function
+    bodies: only brace nesting and quoted strings are tracked, no tokens
+    are built for the content that would be thrown away anyway.
+
+    """
+
+    def __init__(self):
+        super(_SkipBracedBlock, self).__init__()
+        self.name = 'braced block'
+        self.mayReturnEmpty = False
+        self.mayIndexError = False
+
+    def parseImpl(self, instring, loc, doActions=True):
+        if loc >= len(instring) or instring[loc] != '{':
+            raise ParseException(instring, loc, "Expected '{'", self)
+        n = len(instring)
+        depth = 1
+        i = loc + 1
+        while i < n:
+            c = instring[i]
+            if c == '{':
+                depth += 1
+            elif c == '}':
+                depth -= 1
+                if depth == 0:
+                    return i + 1, []
+            elif c == '"' or c == "'":
+                i += 1
+                while i < n and instring[i] != c:
+                    i += 2 if instring[i] == '\\' else 1
+            i += 1
+        raise ParseException(instring, loc, "Unmatched '{'", self)
+
+
 def flatten(lst):
-        res = []
-        for i in lst:
+    """Flatten nested lists/tuples into a flat list of strings iteratively.
+
+    """
+    res = []
+    stack = [iter(lst)]
+    while stack:
+        for i in stack[-1]:
             if isinstance(i, (list, tuple)):
-                res.extend(flatten(i))
-            else:
-                res.append(str(i))
-        return res
+                stack.append(iter(i))
+                break
+            res.append(i if isinstance(i, str) else str(i))
+        else:
+            stack.pop()
+    return res
 
 
 def recombine(tok):
@@ -1664,6 +2013,14 @@ number = (floating | integer)
 
 # Miscelaneous
 bi_operator = oneOf("+ - / * | & || && ! ~ ^ % == != > < >= <= -> . :: << >> = ? :")
+
+# Rewrites preprocessor expressions into eval'able Python (any identifier
+# left after macro expansion evaluates to 0).
+_pp_macro_diffs = (
+    Literal('!').setParseAction(lambda: ' not ') |
+    Literal('&&').setParseAction(lambda: ' and ') |
+    Literal('||').setParseAction(lambda: ' or ') |
+    Word(alphas + '_', alphanums + '_').setParseAction(lambda: '0'))
 uni_right_operator = oneOf("++ --")
 uni_left_operator = oneOf("++ -- - + * sizeof new")
 wordchars = alphanums+'_$'
@@ -1689,6 +2046,27 @@ c99_int_types = ['int8_t', 'uint8_t', 'int16_t', 'uint16_t',
 num_types = ['int', 'float', 'double'] + c99_int_types
 nonnum_types = ['char', 'bool', 'void']
 
+#: Words that may appear in a fundamental type specification. Rebuilt by
+#: _init_cparser when extra types are registered.
+_fund_type_names = frozenset(num_types + nonnum_types + size_modifiers +
+                             sign_modifiers)
+
+#: Single-line typedefs of plain fundamental types. These are by far the
+#: most common typedef shape and are handled by CParser.parse_defs without
+#: invoking the full grammar.
+_SIMPLE_TYPEDEF_RE = re.compile(
+    r'\btypedef[^\S\n]+'
+    r'((?:(?:{0})[^\S\n]+)*(?:{0}))'
+    r'[^\S\n]+(\w+(?:[^\S\n]*,[^\S\n]*\w+)*)[^\S\n]*;'.format(
+        '|'.join(sorted(size_modifiers + sign_modifiers + num_types +
+                        nonnum_types, key=len, reverse=True))))
+
+#: Braces outside of quoted strings, used to track nesting depth in
+#: CParser._parse_simple_typedefs.
+_BRACE_RE = re.compile(r'"(?:\\.|[^"\\\n])*"'
+                       r"|'(?:\\.|[^'\\\n])*'"
+                       r'|[{}]')
+
 
 # Define some common language elements when initialising.
 def _init_cparser(extra_types=None, extra_modifiers=None):
@@ -1697,11 +2075,16 @@ def _init_cparser(extra_types=None, extra_modifiers=None):
     global base_types
     global type_qualifier, storage_class_spec, extra_modifier
     global fund_type
-    global extra_type_list
+    global extra_type_list, _fund_type_names
+
+    # The shared grammar is built on top of the elements defined here and
+    # must be rebuilt with them.
+    _build_grammar.cache_clear()
 
     # Some basic definitions
     extra_type_list = [] if extra_types is None else list(extra_types)
     base_types = nonnum_types + num_types + extra_type_list
+    _fund_type_names = frozenset(base_types + size_modifiers + sign_modifiers)
     storage_classes = ['inline', 'static', 'extern']
     qualifiers = ['const', 'volatile', 'restrict', 'near', 'far']
 
@@ -1721,7 +2104,8 @@ def _init_cparser(extra_types=None, extra_modifiers=None):
     underscore_2_ident = (WordStart(wordchars) + ~keyword + '__' +
                           Word(alphanums, alphanums+"_$") +
                           WordEnd(wordchars)).setParseAction(lambda t: t[0])
-    type_qualifier = ZeroOrMore((underscore_2_ident + Optional(nestedExpr())) |
+    type_qualifier = ZeroOrMore((underscore_2_ident +
+                                 Optional(nestedExpr())).suppress() |
                                 kwl(qualifiers))
 
     storage_class_spec = Optional(kwl(storage_classes))
@@ -1738,27 +2122,208 @@ def _init_cparser(extra_types=None, extra_modifiers=None):
                           base_types)).setParseAction(lambda t: ' '.join(t))
 
     # Is there a better way to process expressions with cast operators??
-    cast_atom = (
-        ZeroOrMore(uni_left_operator) + Optional('('+ident+')').suppress() +
-        ((ident + '(' + Optional(delimitedList(expression)) + ')' |
-          ident + OneOrMore('[' + expression + ']') |
-          ident | number | quotedString
-          ) |
-         ('(' + expression + ')')) +
-        ZeroOrMore(uni_right_operator)
+    # The ident is matched once and the call/subscript postfix hung off it,
+    # rather than re-trying ident for each alternative.
+    primary = (
+        (ident + Optional('(' + Optional(delimitedList(expression)) + ')' |
+                          OneOrMore('[' + expression + ']')) |
+         number | quotedString
+         ) |
+        ('(' + expression + ')')
         )
 
-    uncast_atom = (
+    # The cast is tried first; if the parenthesized group was really a
+    # sub-expression rather than a cast, the second branch picks it up.
+    atom = (
         ZeroOrMore(uni_left_operator) +
-        ((ident + '(' + Optional(delimitedList(expression)) + ')' |
-          ident + OneOrMore('[' + expression + ']') |
-          ident | number | quotedString
-          ) |
-         ('(' + expression + ')')) +
+        (Optional('('+ident+')').suppress() + primary | primary) +
         ZeroOrMore(uni_right_operator)
         )
 
-    atom = cast_atom | uncast_atom
-
     expression << Group(atom + ZeroOrMore(bi_operator + atom))
     expression.setParseAction(recombine)
+
+
+_GRAMMAR_FIELDS = ['type_spec', 'declarator', 'abstract_declarator',
+                   'declarator_list', 'type_decl', 'variable_decl',
+                   'typeless_function_decl', 'function_decl', 'struct_type',
+                   'struct_member', 'decl_list', 'struct_decl', 'enum_type',
+                   'enum_decl', 'parser']
+
+_Grammar = namedtuple('_Grammar', _GRAMMAR_FIELDS)
+
+#: CParser whose definitions the shared grammar's parse actions target.
+#: Set by build_parser, which every processing entry point calls first.
+_active_parser = None
+
+
+@lru_cache(maxsize=None)
+def _build_grammar():
+    """Build the shared tree of parser elements for the C language.
+
+    Grammar construction dominates short parses, so the result is cached
+    for the lifetime of the process (_init_cparser invalidates it). Parse
+    actions are routed through the module-level _active_parser so the same
+    grammar can serve every CParser instance.
+
+    """
+    struct_type = Forward()
+    enum_type = Forward()
+    type_ = (fund_type |
+             Optional(kwl(size_modifiers + sign_modifiers)) + ident |
+             struct_type |
+             enum_type)
+    if extra_modifier is not None:
+        type_ += extra_modifier
+    type_.setParseAction(recombine)
+    type_spec = (type_qualifier('pre_qual') +
+                 type_("name"))
+
+    # --- Abstract declarators for use in function pointer arguments
+    #   Thus begins the extremely hairy business of parsing C declarators.
+    #   Whomever decided this was a reasonable syntax should probably never
+    #   breed.
+    #   The following parsers combined with the process_declarator function
+    #   allow us to turn a nest of type modifiers into a correctly
+    #   ordered list of modifiers.
+
+    declarator = Forward()
+    abstract_declarator = Forward()
+
+    #  Abstract declarators look like:
+    #     <empty string>
+    #     *
+    #     **[num]
+    #     (*)(int, int)
+    #     *( )(int, int)[10]
+    #     ...etc...
+    abstract_declarator << Group(
+        type_qualifier('first_typequal') +
+        Group(ZeroOrMore(Group(Suppress('*') + type_qualifier)))('ptrs') +
+        ((Optional('&')('ref')) |
+         (lparen + abstract_declarator + rparen)('center')) +
+        Optional(lparen +
+                 Optional(delimitedList(Group(
+                          type_spec('type') +
+                          abstract_declarator('decl') +
+                          Optional(Literal('=').suppress() + expression,
+                                   default=None)('val')
+                          )), default=None) +
+                 rparen)('args') +
+        Group(ZeroOrMore(lbrack + Optional(expression, default='-1') +
+              rbrack))('arrays')
+    )
+
+    # Declarators look like:
+    #     varName
+    #     *varName
+    #     **varName[num]
+    #     (*fnName)(int, int)
+    #     * fnName(int arg1=0)[10]
+    #     ...etc...
+    declarator << Group(
+        type_qualifier('first_typequal') + call_conv +
+        Group(ZeroOrMore(Group(Suppress('*') + type_qualifier)))('ptrs') +
+        ((Optional('&')('ref') + ident('name')) |
+         (lparen + declarator + rparen)('center')) +
+        Optional(lparen +
+                 Optional(delimitedList(
+                     Group(type_spec('type') +
+                           (declarator |
+                            abstract_declarator)('decl') +
+                           Optional(Literal('=').suppress() +
+                           expression, default=None)('val')
+                           )),
+                          default=None) +
+                 rparen)('args') +
+        Group(ZeroOrMore(lbrack + Optional(expression, default='-1') +
+              rbrack))('arrays')
+    )
+    declarator_list = Group(delimitedList(declarator))
+
+    # Typedef
+    type_decl = (Keyword('typedef') + type_spec('type') +
+                 declarator_list('decl_list') + semi)
+    type_decl.setParseAction(
+        lambda s, l, t: _active_parser.process_typedef(s, l, t))
+
+    # Variable declaration
+    variable_decl = (
+        Group(storage_class_spec +
+              type_spec('type') +
+              Optional(declarator_list('decl_list')) +
+              Optional(Literal('=').suppress() +
+                       (expression('value') |
+                        (lbrace +
+                         Group(delimitedList(expression))('array_values') +
+                         rbrace
+                         )
+                        )
+                       )
+              ) +
+        semi)
+    variable_decl.setParseAction(
+        lambda s, l, t: _active_parser.process_variable(s, l, t))
+
+    # Function definition
+    function_body = _SkipBracedBlock()
+    typeless_function_decl = (declarator('decl') +
+                              function_body.suppress())
+    function_decl = (storage_class_spec +
+                     type_spec('type') +
+                     declarator('decl') +
+                     function_body.suppress())
+    function_decl.setParseAction(
+        lambda s, l, t: _active_parser.process_function(s, l, t))
+
+    # Struct definition
+    struct_kw = (Keyword('struct') | Keyword('union'))
+    # Clear the inherited process_variable action without installing a
+    # no-op lambda that pyparsing would invoke on every member match.
+    member_var_decl = variable_decl.copy()
+    member_var_decl.parseAction = []
+    struct_member = (
+        Group(member_var_decl) |
+        # Hack to handle bit width specification.
+        Group(Group(type_spec('type') +
+                    Optional(declarator_list('decl_list')) +
+                    colon + integer('bit') + semi)) |
+        (type_spec + declarator + function_body).suppress() |
+        (declarator + function_body).suppress()
+        )
+
+    decl_list = (lbrace +
+                 Group(OneOrMore(struct_member))('members') +
+                 rbrace)
+    struct_type << (struct_kw('struct_type') +
+                    ((Optional(ident)('name') +
+                      decl_list) | ident('name'))
+                    )
+    struct_type.setParseAction(
+        lambda s, l, t: _active_parser.process_struct(s, l, t))
+
+    struct_decl = struct_type + semi
+
+    # Enum definition
+    enum_var_decl = Group(ident('name') +
+                          Optional(Literal('=').suppress() +
+                          expression('value')))
+
+    enum_type << (Keyword('enum') +
+                  (Optional(ident)('name') +
+                   lbrace +
+                   Group(delimitedList(enum_var_decl))('members') +
+                   Optional(comma) + rbrace | ident('name'))
+                  )
+    enum_type.setParseAction(
+        lambda s, l, t: _active_parser.process_enum(s, l, t))
+    enum_decl = enum_type + semi
+
+    parser = (type_decl | variable_decl | function_decl)
+
+    return _Grammar(type_spec, declarator, abstract_declarator,
+                    declarator_list, type_decl, variable_decl,
+                    typeless_function_decl, function_decl, struct_type,
+                    struct_member, decl_list, struct_decl, enum_type,
+                    enum_decl, parser)
+
@@ -45,5 +45,6 @@ cdll/windll.''',
 	package_data = {'pyclibrary': ['headers/*']},
     requires = ['future'],
     install_requires = ['future'],
+    extras_require = {'cparser': ['cpyparsing>=2.4']},
 )
 
@@ -215,6 +215,17 @@ class TestFileHandling(object):
         assert self.parser.init_opts['replace']['replace.h'] == rep
         assert self.parser.init_opts['files'] == ['replace.h']
 
+    def test_load_file_and_replace_with_groups(self):
+
+        path = os.path.join(self.h_dir, 'replace.h')
+        rep = {r'define (MACRO) \{placeholder\}': r'define \1 1',
+               r'define (MACRO2) placeholder2': r'define \1 2'}
+        assert self.parser.load_file(path, rep)
+
+        lines = self.parser.files[path].split('\n')
+        assert lines[3] == '# define MACRO 1'
+        assert lines[6] == '    # define MACRO2 2'
+
     def test_load_non_existing_file(self):
 
         path = os.path.join(self.h_dir, 'no.h')
@@ -226,7 +237,7 @@ class TestFileHandling(object):
         path = os.path.join(self.h_dir, 'c_comments.h')
         self.parser.load_file(path)
         self.parser.remove_comments(path)
-        with open(os.path.join(self.h_dir, 'c_comments_removed.h'), 'rU') as f:
+        with open(os.path.join(self.h_dir, 'c_comments_removed.h'), 'r') as f:
             compare_lines(self.parser.files[path].split('\n'), f.readlines())
 
     def test_removing_cpp_comments(self):
@@ -235,7 +246,7 @@ class TestFileHandling(object):
         self.parser.load_file(path)
         self.parser.remove_comments(path)
         with open(os.path.join(self.h_dir,
-                               'cpp_comments_removed.h'), 'rU') as f:
+                               'cpp_comments_removed.h'), 'r') as f:
             compare_lines(self.parser.files[path].split('\n'), f.readlines())
 
 
@@ -786,3 +797,28 @@ class TestParsing(object):
         ptyp = Type('int', '*', '*', type_quals=(('volatile',), ('const',), ()))
         assert functions.get('typeQualedFunc') == \
                Type(Type('int'), ((None, ptyp, None),))
+
+    def test_multiple_parsers(self):
+
+        # The grammar is shared between instances, but definitions gathered
+        # by parsers used in turn must stay per-instance.
+        parser2 = CParser(process_all=False)
+        self.parser.load_file(os.path.join(self.h_dir, 'enums.h'))
+        parser2.load_file(os.path.join(self.h_dir, 'functions.h'))
+        self.parser.process_all()
+        parser2.process_all()
+
+        assert 'enum_name' in self.parser.defs['enums']
+        assert 'f' in parser2.defs['functions']
+        assert self.parser.defs['functions'] == {}
+        assert parser2.defs['enums'] == {}
+
+    def test_declarator_cache_is_used(self):
+
+        # Repeated pointer/function declarators must land in the
+        # memoization cache (declarators with array sizes stay out).
+        path = os.path.join(self.h_dir, 'functions.h')
+        self.parser.load_file(path)
+        self.parser.process_all()
+
+        assert len(self.parser._decl_cache) > 0